@@ -180,13 +180,16 @@ class SimulationRunner(object):
         """
         return self._mutation_rate
 
-    def run(self, output):
+    def run(self, output, command_line=None):
         """
         Runs the simulations and writes the output to the specified
-        file handle.
+        file handle. The first line of output is the specified list of
+        command line arguments, or sys.argv if this is not provided.
         """
+        if command_line is None:
+            command_line = sys.argv
         # The first line of ms's output is the command line.
-        print(" ".join(sys.argv), file=output)
+        print(" ".join(command_line), file=output)
         print(" ".join(str(s) for s in self._ms_random_seeds), file=output)
         for j in range(self._num_replicates):
             self._simulator.run()
@@ -997,12 +997,8 @@ class TreeSimulator(object):
 
     def get_num_migration_events(self):
         N = self.get_num_populations()
-        matrix = [[0 for j in range(N)] for k in range(N)]
         flat = self._ll_sim.get_num_migration_events()
-        for j in range(N):
-            for k in range(N):
-                matrix[j][k] = flat[j * N + k]
-        return matrix
+        return [flat[j * N: (j + 1) * N] for j in range(N)]
 
     def get_total_num_migration_events(self):
         return sum(self._ll_sim.get_num_migration_events())
@@ -1080,12 +1076,9 @@ class TreeSimulator(object):
         # counterparts.
         d = len(self._population_configurations)
         Ne = self.get_effective_population_size()
-        # The migration matrix must be flattened.
-        scaled_migration_matrix = self.get_scaled_migration_matrix()
-        ll_migration_matrix = [0 for j in range(d**2)]
-        for j in range(d):
-            for k in range(d):
-                ll_migration_matrix[j * d + k] = scaled_migration_matrix[j][k]
+        # The migration matrix must be flattened in row-major order.
+        ll_migration_matrix = [
+            m for row in self.get_scaled_migration_matrix() for m in row]
         ll_population_configuration = [
             conf.get_ll_representation(Ne)
             for conf in self._population_configurations]
@@ -2194,5 +2187,11 @@ def harmonic_number(n):
     """
     Returns the nth Harmonic number.
     """
-    EulerGamma = 0.5772156649
-    return math.log(n) + EulerGamma
+    if n < 64:
+        return sum(1 / k for k in range(1, n + 1))
+    # For larger n we use the asymptotic expansion, which is accurate
+    # to within 1 / (252 n^6).
+    EulerGamma = 0.5772156649015329
+    return (
+        math.log(n) + EulerGamma + 1 / (2 * n) - 1 / (12 * n**2) +
+        1 / (120 * n**4))
@@ -966,6 +966,15 @@ class TestMspmsOutput(unittest.TestCase):
         self.verify_output(random_seeds=None)
         self.verify_output(random_seeds=[2, 3, 4])
 
+    def test_command_line_output(self):
+        command_line = ["mspms", "10", "1", "-t", "2.0"]
+        sr = cli.SimulationRunner(sample_size=10, scaled_mutation_rate=2.0)
+        with tempfile.TemporaryFile("w+") as f:
+            sr.run(f, command_line)
+            f.seek(0)
+            line = f.readline().rstrip()
+        self.assertEqual(line, " ".join(command_line))
+
     def test_correct_streams(self):
         args = "15 1 -r 0 1.0 -eG 1.0 5.25 -eG 2.0 10 -G 4 -eN 3.0 1.0 -T"
         stdout, stderr = capture_output(cli.mspms_main, args.split())
@@ -121,6 +121,12 @@ class TestHarmonicNumber(unittest.TestCase):
         for n in range(10, 1000, 100):
             self.assertAlmostEqual(msprime.harmonic_number(n), H(n), 1)
 
+    def test_harmonic_number_precision(self):
+        def H(n):
+            return sum(1 / k for k in range(1, n + 1))
+        for n in range(1, 1000):
+            self.assertAlmostEqual(msprime.harmonic_number(n), H(n), 9)
+
 
 class TestMsCommandLine(tests.MsprimeTestCase):
     """
@@ -0,0 +1,138 @@
+#
+# Copyright (C) 2016 Jerome Kelleher <jerome.kelleher@well.ox.ac.uk>
+#
+# This file is part of msprime.
+#
+# msprime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# msprime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with msprime.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Test cases for the pipelines in the verification script.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+# The verification script needs pandas, statsmodels, matplotlib and
+# dendropy, which are not required to run the rest of the tests.
+_verification_available = True
+try:
+    import verification
+except ImportError:
+    _verification_available = False
+
+_sample_stats_executable = "./data/ms/sample_stats"
+
+
+class FakeSimulationRunner(object):
+    """
+    Stand-in for an mspms SimulationRunner that writes the specified number
+    of replicates with no segregating sites in ms format.
+    """
+    def __init__(self, num_replicates):
+        self.num_replicates = num_replicates
+
+    def run(self, output, command_line):
+        print(" ".join(command_line), file=output)
+        print("1 2 3", file=output)
+        for _ in range(self.num_replicates):
+            print(file=output)
+            print("//", file=output)
+            print("segsites: 0", file=output)
+            print(file=output)
+
+
+def failing_read_stats_table(f, dtype):
+    """
+    Reads the first line of the specified file and then fails as if the
+    table could not be parsed.
+    """
+    f.readline()
+    raise ValueError("Forced parse failure")
+
+
+@unittest.skipUnless(
+    _verification_available, "verification dependencies not available")
+@unittest.skipUnless(
+    os.path.exists(_sample_stats_executable), "sample_stats not built")
+class TestMsprimeMutationStats(unittest.TestCase):
+    """
+    Tests for running mspms in-process and piping its output through
+    sample_stats.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="msp_verification_")
+        self.verifier = verification.SimulationVerifier(self.temp_dir)
+        # The seeds are not used by the fake runner.
+        self.verifier.get_ms_seeds = lambda: []
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_mutation_stats(self, num_replicates, timeout=60):
+        """
+        Runs the msprime mutation stats for a fake runner in a separate
+        thread, and returns the thread along with the list of results or
+        exceptions that it produced.
+        """
+        arg_list = ["4", str(num_replicates), "-t", "1.0"]
+        runner = FakeSimulationRunner(num_replicates)
+        results = []
+
+        def target():
+            try:
+                results.append(
+                    self.verifier._run_msprime_mutation_stats(arg_list))
+            except Exception as e:
+                results.append(e)
+
+        with mock.patch("msprime.cli.get_mspms_runner", return_value=runner):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+        return thread, results
+
+    def test_output(self):
+        num_replicates = 10
+        thread, results = self.run_mutation_stats(num_replicates)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(results), 1)
+        df = results[0]
+        self.assertEqual(len(df), num_replicates)
+        self.assertEqual(
+            set(df.columns.values), set(verification.SAMPLE_STATS_DTYPES))
+        self.assertTrue(all(df["ss"] == 0))
+
+    def test_parse_failure(self):
+        # Write enough output that sample_stats and the writer thread
+        # would block on their pipes if we stopped reading without
+        # cleaning up.
+        num_replicates = 10**5
+        num_threads = threading.active_count()
+        with mock.patch(
+                "verification._read_stats_table",
+                side_effect=failing_read_stats_table):
+            thread, results = self.run_mutation_stats(num_replicates)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], ValueError)
+        # The writer thread must also have been reaped.
+        self.assertEqual(threading.active_count(), num_threads)
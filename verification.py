@@ -6,11 +6,14 @@ from __future__ import print_function
 from __future__ import division
 
 import math
+import multiprocessing
 import os
 import random
+import re
+import signal
 import subprocess
 import sys
-import tempfile
+import threading
 
 import scipy.special
 import pandas as pd
@@ -21,12 +24,150 @@ import matplotlib
 # Force matplotlib to not use any Xwindows backend.
 matplotlib.use('Agg')
 from matplotlib import pyplot
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 import dendropy
 import msprime.cli as cli
 
 import msprime
 
+# The output of the ms-like programs is parsed directly from their stdout
+# pipes, so we use block buffering to avoid reading a byte at a time.
+PIPE_BUFFER_SIZE = 64 * 1024
+
+# The number of chunks that the msprime coalescent statistics replicates
+# are split into, each of which is run with its own random seed.
+COALESCENT_STATS_NUM_CHUNKS = 32
+
+# The column types of the output of sample_stats and ms_summary_stats. The
+# mig_events_* columns of the latter depend on the number of populations
+# and are left for pandas to infer.
+SAMPLE_STATS_DTYPES = {
+    "pi": np.float64, "ss": np.int64, "D": np.float64,
+    "thetaH": np.float64, "H": np.float64}
+COALESCENT_STATS_DTYPES = {
+    "t": np.float64, "num_trees": np.int64, "re_events": np.int64,
+    "ca_events": np.int64}
+
+
+def _read_stats_table(f, dtype, chunksize=64 * 1024):
+    """
+    Reads a tab separated table of statistics from the specified file
+    using the specified column types, and returns it as a DataFrame.
+    The table is parsed in chunks of the specified number of rows, so
+    that the memory used by the parser does not grow with the number
+    of replicates.
+    """
+    chunks = pd.read_csv(
+        f, sep="\t", engine="c", dtype=dtype, chunksize=chunksize)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _check_wait(process, args):
+    """
+    Waits for the specified subprocess to finish, and raises a
+    CalledProcessError if it exited with a non-zero status, in the same
+    way as subprocess.check_call.
+    """
+    returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+
+
+def _restore_sigpipe():
+    """
+    Restores the default SIGPIPE handler. Python 2 ignores SIGPIPE and
+    child processes inherit this, so this is passed as the preexec_fn for
+    the ms-like programs to make them exit when their output is closed.
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+def _read_process_stats_table(f, dtype, processes):
+    """
+    Reads a table of statistics from the specified output file of the
+    specified list of (process, args) pairs, then waits for each process
+    and checks its exit status. If the table cannot be parsed we check the
+    exit statuses first, since a failed process will usually have written
+    an empty or truncated table.
+    """
+    try:
+        df = _read_stats_table(f, dtype)
+    except Exception:
+        # Close the output so that a process still writing to it cannot
+        # block; it is then killed by the SIGPIPE that we caused, since
+        # the processes are started with the default SIGPIPE handler.
+        f.close()
+        for process, args in processes:
+            returncode = process.wait()
+            if returncode not in (0, -signal.SIGPIPE):
+                raise subprocess.CalledProcessError(returncode, args)
+        raise
+    for process, args in processes:
+        _check_wait(process, args)
+    return df
+
+
+def _run_msprime_coalescent_replicates(work):
+    """
+    Runs the specified number of replicates of the mspms command line using
+    the specified random seed, and returns arrays of the coalescent
+    statistics t, num_trees, ca_events, re_events and mig_events for these
+    replicates. The mig_events array has one row per replicate holding the
+    flattened matrix of migration event counts. This is a module level
+    function so that it can be called from a multiprocessing Pool.
+    """
+    arg_list, seed, num_replicates = work
+    # The simulator is built once and reset between replicates, so that
+    # the configuration and memory allocations are shared across the chunk.
+    runner = cli.get_mspms_runner(arg_list)
+    sim = runner.get_simulator()
+    sim.set_random_generator(msprime.RandomGenerator(seed))
+    num_populations = sim.get_num_populations()
+    time = np.empty(num_replicates)
+    num_trees = np.empty(num_replicates, dtype=np.int64)
+    ca_events = np.empty(num_replicates, dtype=np.int64)
+    re_events = np.empty(num_replicates, dtype=np.int64)
+    # There can be no migration events with a single population, so we
+    # leave the counts at zero rather than querying them every replicate.
+    mig_events = np.zeros(
+        (num_replicates, num_populations**2), dtype=np.int64)
+    count_migrations = num_populations > 1
+    for j in range(num_replicates):
+        sim.reset()
+        sim.run()
+        time[j] = sim.get_time() / 4  # Convert to coalescent units
+        num_trees[j] = sim.get_num_breakpoints() + 1
+        ca_events[j] = sim.get_num_common_ancestor_events()
+        re_events[j] = sim.get_num_recombination_events()
+        if count_migrations:
+            mig_events[j] = np.ravel(sim.get_num_migration_events())
+    return time, num_trees, ca_events, re_events, mig_events
+
+
+def _plot_qqplot(v1, v2, filename):
+    """
+    Writes a QQ-plot comparing the specified pair of samples to the
+    specified file.
+    """
+    # We use the object oriented matplotlib API rather than pyplot so that
+    # the figure is not registered with pyplot's global figure manager.
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot(111)
+    sm.qqplot_2samples(v1, v2, line="45", ax=ax)
+    figure.savefig(filename, dpi=72)
+
+
+def _plot_qqplot_worker(work):
+    """
+    Calls _plot_qqplot with the specified tuple of arguments. This is a
+    module level function so that it can be called from a multiprocessing
+    Pool.
+    """
+    _plot_qqplot(*work)
+
 
 class SimulationVerifier(object):
     """
@@ -37,7 +178,7 @@ class SimulationVerifier(object):
         self._output_dir = output_dir
         self._instances = {}
         self._ms_executable = ["./data/ms/ms"]
-        self._mspms_executable = ["python", "mspms_dev.py"]
+        self._mspms_executable = [sys.executable, "mspms_dev.py"]
 
     def get_ms_seeds(self):
         max_seed = 2**16
@@ -46,64 +187,112 @@ class SimulationVerifier(object):
 
     def _run_sample_stats(self, args):
         print("\t", " ".join(args))
-        p1 = subprocess.Popen(args, stdout=subprocess.PIPE)
+        p1 = subprocess.Popen(
+            args, stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE,
+            preexec_fn=_restore_sigpipe)
         p2 = subprocess.Popen(
             ["./data/ms/sample_stats"], stdin=p1.stdout,
-            stdout=subprocess.PIPE)
+            stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE,
+            preexec_fn=_restore_sigpipe)
         p1.stdout.close()
-        output = p2.communicate()[0]
-        with tempfile.TemporaryFile() as f:
-            f.write(output)
-            f.seek(0)
-            df = pd.read_table(f)
+        df = _read_process_stats_table(
+            p2.stdout, SAMPLE_STATS_DTYPES,
+            [(p2, ["./data/ms/sample_stats"]), (p1, args)])
         return df
 
-    def _run_ms_mutation_stats(self, args):
-        return self._run_sample_stats(
-            self._ms_executable + args.split() + self.get_ms_seeds())
-
-    def _run_msprime_mutation_stats(self, args):
+    def _run_ms_mutation_stats(self, arg_list):
         return self._run_sample_stats(
-            self._mspms_executable + args.split() + self.get_ms_seeds())
+            self._ms_executable + arg_list + self.get_ms_seeds())
+
+    def _run_msprime_mutation_stats(self, arg_list):
+        arg_list = arg_list + self.get_ms_seeds()
+        print("\t msprime:", " ".join(arg_list))
+        runner = cli.get_mspms_runner(arg_list)
+        # We run mspms in this process to avoid starting a new interpreter
+        # and importing msprime, and write its output to sample_stats from
+        # a separate thread while we read the results.
+        p = subprocess.Popen(
+            ["./data/ms/sample_stats"], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE,
+            preexec_fn=_restore_sigpipe, universal_newlines=True)
+
+        # Any exception raised while writing is stored so that it can be
+        # re-raised here; otherwise sample_stats would see a truncated
+        # input and we would silently return a partial result.
+        errors = []
+
+        def write_output():
+            try:
+                runner.run(p.stdin, ["mspms"] + arg_list)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    p.stdin.close()
+                except IOError:
+                    # Flushing fails if sample_stats has already exited.
+                    pass
+
+        thread = threading.Thread(target=write_output)
+        thread.daemon = True
+        thread.start()
+        try:
+            df = _read_process_stats_table(
+                p.stdout, SAMPLE_STATS_DTYPES,
+                [(p, ["./data/ms/sample_stats"])])
+        finally:
+            # sample_stats has exited by this point, so the writer will
+            # finish, if only with a broken pipe.
+            thread.join()
+        if len(errors) > 0:
+            raise errors[0]
+        return df
 
-    def _run_ms_coalescent_stats(self, args):
+    def _run_ms_coalescent_stats(self, arg_list):
         executable = ["./data/ms/ms_summary_stats"]
-        with tempfile.TemporaryFile() as f:
-            argList = executable + args.split() + self.get_ms_seeds()
-            print("\t", " ".join(argList))
-            subprocess.call(argList, stdout=f)
-            f.seek(0)
-            df = pd.read_table(f)
+        argList = executable + arg_list + self.get_ms_seeds()
+        print("\t", " ".join(argList))
+        p = subprocess.Popen(
+            argList, stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE,
+            preexec_fn=_restore_sigpipe)
+        df = _read_process_stats_table(
+            p.stdout, COALESCENT_STATS_DTYPES, [(p, argList)])
         return df
 
-    def _run_msprime_coalescent_stats(self, args):
-        print("\t msprime:", args)
-        runner = cli.get_mspms_runner(args.split())
-        sim = runner.get_simulator()
-        rng = msprime.RandomGenerator(random.randint(1, 2**32 - 1))
-        sim.set_random_generator(rng)
-        num_populations = sim.get_num_populations()
-        replicates = runner.get_num_replicates()
-        num_trees = [0 for j in range(replicates)]
-        time = [0 for j in range(replicates)]
-        ca_events = [0 for j in range(replicates)]
-        re_events = [0 for j in range(replicates)]
-        mig_events = [None for j in range(replicates)]
-        for j in range(replicates):
-            sim.reset()
-            sim.run()
-            num_trees[j] = sim.get_num_breakpoints() + 1
-            time[j] = sim.get_time() / 4  # Convert to coalescent units
-            ca_events[j] = sim.get_num_common_ancestor_events()
-            re_events[j] = sim.get_num_recombination_events()
-            mig_events[j] = [
-                r for row in sim.get_num_migration_events() for r in row]
+    def _run_msprime_coalescent_stats(self, arg_list):
+        print("\t msprime:", " ".join(arg_list))
+        # The simulators are built inside the workers, so we only need to
+        # parse the arguments here to find out how many replicates to run.
+        parser = cli.get_mspms_parser()
+        replicates = parser.parse_args(arg_list).num_replicates
+        # Replicates are independent, so we farm them out in chunks to a
+        # pool of worker processes, each chunk with its own random seed.
+        # The number of chunks is fixed so that the results depend only on
+        # the state of the random module and not on the number of CPUs.
+        # Each chunk parses the arguments and sets up its simulator once.
+        num_chunks = min(COALESCENT_STATS_NUM_CHUNKS, replicates)
+        chunk_size = int(math.ceil(replicates / num_chunks))
+        num_workers = min(multiprocessing.cpu_count(), num_chunks)
+        work = []
+        j = 0
+        while j < replicates:
+            num_replicates = min(chunk_size, replicates - j)
+            seed = random.randint(1, 2**32 - 1)
+            work.append((arg_list, seed, num_replicates))
+            j += num_replicates
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            chunks = pool.map(_run_msprime_coalescent_replicates, work)
+        finally:
+            pool.close()
+            pool.join()
+        time, num_trees, ca_events, re_events, mig_events = [
+            np.concatenate(arrays) for arrays in zip(*chunks)]
         d = {
             "t": time, "num_trees": num_trees,
             "ca_events": ca_events, "re_events": re_events}
-        for j in range(num_populations**2):
-            events = [mig_events[k][j] for k in range(replicates)]
-            d["mig_events_{}".format(j)] = events
+        for j in range(mig_events.shape[1]):
+            d["mig_events_{}".format(j)] = mig_events[:, j]
         df = pd.DataFrame(d)
         return df
 
@@ -115,23 +304,29 @@ class SimulationVerifier(object):
 
     def _plot_stats(self, key, stats_type, df_msp, df_ms):
         assert set(df_ms.columns.values) == set(df_msp.columns.values)
-        for stat in df_ms.columns.values:
-            v1 = df_ms[stat]
-            v2 = df_msp[stat]
-            sm.graphics.qqplot(v1)
-            sm.qqplot_2samples(v1, v2, line="45")
-            f = self._build_filename(key, stats_type, stat)
-            pyplot.savefig(f, dpi=72)
-            pyplot.close('all')
-
-    def _run_coalescent_stats(self, key, args):
-        df_msp = self._run_msprime_coalescent_stats(args)
-        df_ms = self._run_ms_coalescent_stats(args)
+        stats = df_ms.columns.values
+        work = [
+            (df_ms[stat].values, df_msp[stat].values,
+                self._build_filename(key, stats_type, stat))
+            for stat in stats]
+        # Rendering the plots is slow and each one is independent, so we
+        # draw them in parallel.
+        num_workers = min(len(stats), multiprocessing.cpu_count())
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            pool.map(_plot_qqplot_worker, work)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_coalescent_stats(self, key, arg_list):
+        df_msp = self._run_msprime_coalescent_stats(arg_list)
+        df_ms = self._run_ms_coalescent_stats(arg_list)
         self._plot_stats(key, "coalescent", df_ms, df_msp)
 
-    def _run_mutation_stats(self, key, args):
-        df_msp = self._run_msprime_mutation_stats(args)
-        df_ms = self._run_ms_mutation_stats(args)
+    def _run_mutation_stats(self, key, arg_list):
+        df_msp = self._run_msprime_mutation_stats(arg_list)
+        df_ms = self._run_ms_mutation_stats(arg_list)
         self._plot_stats(key, "mutation", df_ms, df_msp)
 
     def run(self, keys=None):
@@ -147,10 +342,14 @@ class SimulationVerifier(object):
         """
         Adds a test instance with the specified ms command line.
         """
+        # Split the command line once here rather than every time one
+        # of the simulators is invoked.
+        arg_list = command_line.split()
+
         def f():
             print(key, command_line)
-            self._run_coalescent_stats(key, command_line)
-            self._run_mutation_stats(key, command_line)
+            self._run_coalescent_stats(key, arg_list)
+            self._run_mutation_stats(key, arg_list)
         self._instances[key] = f
 
     def get_pairwise_coalescence_time(self, cmd, R):
@@ -193,28 +392,20 @@ class SimulationVerifier(object):
                     np.mean(T_b_ms), np.mean(T_b_msp), (d + (d - 1) / M) / 2,
                     sep="\t")
 
-            sm.graphics.qqplot(T_w_ms)
-            sm.qqplot_2samples(T_w_ms, T_w_msp, line="45")
             f = os.path.join(basedir, "within_{}.png".format(d))
-            pyplot.savefig(f, dpi=72)
-            pyplot.close('all')
-
-            sm.graphics.qqplot(T_b_ms)
-            sm.qqplot_2samples(T_b_ms, T_b_msp, line="45")
+            _plot_qqplot(T_w_ms, T_w_msp, f)
             f = os.path.join(basedir, "between_{}.png".format(d))
-            pyplot.savefig(f, dpi=72)
-            pyplot.close('all')
+            _plot_qqplot(T_b_ms, T_b_msp, f)
 
     def get_segregating_sites_histogram(self, cmd):
         print("\t", " ".join(cmd))
         output = subprocess.check_output(cmd)
         max_s = 200
-        hist = np.zeros(max_s)
-        for line in output.splitlines():
-            if line.startswith("segsites"):
-                s = int(line.split()[1])
-                if s <= max_s:
-                    hist[s] += 1
+        # Pull out all of the segsites values in a single pass over the
+        # output rather than examining it line-by-line in Python.
+        S = np.array(
+            re.findall(r"^segsites: (\d+)", output, re.MULTILINE), dtype=int)
+        hist = np.bincount(S[S < max_s], minlength=max_s)
         return hist / np.sum(hist)
 
     def get_S_distribution(self, k, n, theta):
@@ -353,11 +544,8 @@ class SimulationVerifier(object):
             tbl_ms = self.get_tbl_distribution(n, R, self._ms_executable)
             tbl_msp = self.get_tbl_distribution(n, R, self._mspms_executable)
 
-            sm.graphics.qqplot(tbl_ms)
-            sm.qqplot_2samples(tbl_ms, tbl_msp, line="45")
             filename = os.path.join(basedir, "qqplot_{}.png".format(n))
-            pyplot.savefig(filename, dpi=72)
-            pyplot.close('all')
+            _plot_qqplot(tbl_ms, tbl_msp, filename)
 
             hist_ms, bin_edges = np.histogram(tbl_ms, 20, density=True)
             hist_msp, _ = np.histogram(tbl_msp, bin_edges, density=True)
@@ -408,6 +596,13 @@ class SimulationVerifier(object):
         self._instances[
             "analytical_pairwise_island"] = self.run_pairwise_island_model
 
+    def _get_random_migration_matrix(self, N):
+        """
+        Returns a random N x N migration matrix with zeros on the diagonal,
+        flattened in row-major order.
+        """
+        return [random.random() * (j % (N + 1) != 0) for j in range(N**2)]
+
     def add_random_instance(
             self, key, num_populations=1, num_replicates=1000,
             num_demographic_events=0):
@@ -416,8 +611,7 @@ class SimulationVerifier(object):
         theta = random.uniform(1, 100)
         N = num_populations
         sample_sizes = [random.randint(2, 10) for _ in range(N)]
-        migration_matrix = [
-            random.random() * (j % (N + 1) != 0) for j in range(N**2)]
+        migration_matrix = self._get_random_migration_matrix(N)
         structure = ""
         if num_populations > 1:
             structure = "-I {} {} -ma {}".format(
@@ -442,9 +636,7 @@ class SimulationVerifier(object):
                     r = random.random()
                     cmd += " -em {} {}".format(t, j, k, r)
                 else:
-                    migration_matrix = [
-                        random.random() * (j % (N + 1) != 0)
-                        for j in range(N**2)]
+                    migration_matrix = self._get_random_migration_matrix(N)
                     cmd += " -ema {} {} {}".format(
                         t, N, " ".join(str(r) for r in migration_matrix))
 